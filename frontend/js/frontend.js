@@ -651,11 +651,9 @@ function buildDrawingGameResultsWidget(caption_by_image_id, prompt_by_image_id)
 {
     _drawingGameResultsContainer.empty();
 
-    const imageIds = new Set(Object.keys(caption_by_image_id));
-    for (const uuid of imageIds)
+    for (const [uuid, caption] of Object.entries(caption_by_image_id))
     {
         const prompt = prompt_by_image_id[uuid];
-        const caption = caption_by_image_id[uuid];
         const image = _imageByUuid[uuid];
 
         /*
@@ -33,35 +33,8 @@ function tryParseMessage(json)
         return null;
     }
 
-    switch (json.__id)
-    {
-    default:
-        return null;
-    case "HelloMessage":
-        return Object.assign(new HelloMessage(), json);
-    case "StartNewGameMessage":
-        return Object.assign(new StartNewGameMessage(), json);
-    case "JoinGameMessage":
-        return Object.assign(new JoinGameMessage(), json);
-    case "LeaveGameMessage":
-        return Object.assign(new LeaveGameMessage(), json);
-    case "GameStartingStateMessage":
-        return Object.assign(new GameStartingStateMessage(), json);
-    case "FailedToJoinMessage":
-        return Object.assign(new FailedToJoinMessage(), json);
-    case "RejoinGameMessage":
-        return Object.assign(new RejoinGameMessage(), json);
-    case "ReturnToLobbyMessage":
-        return Object.assign(new ReturnToLobbyMessage(), json);
-    case "SelectGameStateMessage":
-        return Object.assign(new SelectGameStateMessage(), json);
-    case "ChooseGameMessage":
-        return Object.assign(new ChooseGameMessage(), json);
-    case "ClientUIMessage":
-        return Object.assign(new ClientUIMessage(), json);
-    case "ClientInputMessage":
-        return Object.assign(new ClientInputMessage(), json);
-    }
+    const messageClass = _messageClassById.get(json.__id);
+    return messageClass ? Object.assign(new messageClass(), json) : null;
 }
 
 class HelloMessage
@@ -195,6 +168,22 @@ class ClientInputMessage
     }
 }
 
+// Message classes by ID, for decoding
+const _messageClassById = new Map([
+    [ "HelloMessage", HelloMessage ],
+    [ "StartNewGameMessage", StartNewGameMessage ],
+    [ "JoinGameMessage", JoinGameMessage ],
+    [ "LeaveGameMessage", LeaveGameMessage ],
+    [ "GameStartingStateMessage", GameStartingStateMessage ],
+    [ "FailedToJoinMessage", FailedToJoinMessage ],
+    [ "RejoinGameMessage", RejoinGameMessage ],
+    [ "ReturnToLobbyMessage", ReturnToLobbyMessage ],
+    [ "SelectGameStateMessage", SelectGameStateMessage ],
+    [ "ChooseGameMessage", ChooseGameMessage ],
+    [ "ClientUIMessage", ClientUIMessage ],
+    [ "ClientInputMessage", ClientInputMessage ]
+]);
+
 export
 {
     tryParseMessage,
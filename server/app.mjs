@@ -55,6 +55,7 @@ import
 import { generateSessionId } from "./modules/utils.mjs";
 import { Session } from "./modules/session.mjs";
 import { ImageGenerator } from "./modules/image_generator.mjs";
+import { serveCompressedAssets } from "./modules/compressed_assets.mjs";
 
 
 /**************************************************************************************************
@@ -62,30 +63,37 @@ import { ImageGenerator } from "./modules/image_generator.mjs";
 **************************************************************************************************/
 
 const _sessionById = {};
+const _sessionByClientId = new Map();    // reverse index, may be stale and must be validated before use
 
 function tryGetSessionByClientId(clientId)
 {
-    for (const [_, session] of Object.entries(_sessionById))
+    const session = _sessionByClientId.get(clientId);
+    if (session && _sessionById[session.id()] === session && session.hasClient(clientId))
     {
-        if (session.hasClient(clientId))
-        {
-            return session;
-        }
+        return session;
     }
     return null;
 }
 
+// Returns true if client was accepted into the session
+function tryAddClientToSession(session, clientId)
+{
+    if (session.tryAddClientIfAccepting(clientId))
+    {
+        _sessionByClientId.set(clientId, session);
+        return true;
+    }
+    return false;
+}
+
 // Terminates a session. If the game ended normally (in which case players will have returned to
 // lobby), gameInterruptedReason is null and no message to the clients will be sent. Otherwise,
 // a return-to-lobby request is sent to clients with the interruption reason.
 function terminateSession(session, gameInterruptedReason)
 {
-    for (const [sessionId, otherSession] of Object.entries(_sessionById))
+    if (_sessionById[session.id()] === session)
     {
-        if (session == otherSession)
-        {
-            delete _sessionById[sessionId];
-        }
+        delete _sessionById[session.id()];
     }
 
     // Force remaining clients to return to lobby if the session was interrupted
@@ -122,6 +130,17 @@ function removeClientFromSession(session, clientId)
     }
 }
 
+// Removes client from the session it belongs to, if any
+function removeClientFromCurrentSession(clientId)
+{
+    const session = tryGetSessionByClientId(clientId);
+    _sessionByClientId.delete(clientId);
+    if (session)
+    {
+        removeClientFromSession(session, clientId);
+    }
+}
+
 
 /**************************************************************************************************
  Socket and Message Handling
@@ -132,8 +151,9 @@ class Client
     clientId;
     socket;
 
-    _pendingMessages = [];  // enqueued messages when socket is disconnected
+    _pendingMessages = [];  // enqueued (serialized) messages when socket is disconnected
     _disconnectedAt = Infinity;
+    _removalTimer = null;   // fires if client does not reconnect in time
 
     getDisconnectedDuration()
     {
@@ -142,7 +162,7 @@ class Client
             // Still connected
             return 0
         }
-        return Date.now() - this._disconnectedAt;
+        return performance.now() - this._disconnectedAt;
     }
 
     isConnected()
@@ -155,33 +175,46 @@ class Client
         if (isConnected)
         {
             this.socket = newSocket;
+            _clientIdBySocket.set(newSocket, this.clientId);
             this._disconnectedAt = Infinity;
+            clearTimeout(this._removalTimer);
+            this._removalTimer = null;
 
             // Send out enqueued messages
-            for (const msg of this._pendingMessages)
+            for (const json of this._pendingMessages)
             {
-                sendMessage(this.socket, msg);
+                sendSerializedMessage(this.socket, json);
             }
             this._pendingMessages = [];
         }
         else
         {
             this.socket = null;
-            this._disconnectedAt = Date.now();
+            this._disconnectedAt = performance.now();
+
+            // Schedule removal in case the client does not reconnect in time
+            clearTimeout(this._removalTimer);
+            this._removalTimer = setTimeout(() => onClientReconnectTimedOut(this), _reconnectTimeout);
         }
     }
 
     sendMessage(msg)
+    {
+        this.sendSerializedMessage(JSON.stringify(msg));
+    }
+
+    // Sends a message that has already been serialized to JSON (see sendSerializedMessage())
+    sendSerializedMessage(json)
     {
         if (this.isConnected())
         {
             // Send immediately
-            sendMessage(this.socket, msg);
+            sendSerializedMessage(this.socket, json);
         }
         else
         {
             // We are not connected. Enqueue for sending on re-connect.
-            this._pendingMessages.push(msg);
+            this._pendingMessages.push(json);
         }
     }
 
@@ -189,6 +222,7 @@ class Client
     {
         this.clientId = clientId;
         this.socket = socket;
+        _clientIdBySocket.set(socket, clientId);
     }
 }
 
@@ -204,29 +238,20 @@ const _handlerByMessageId =
 };
 
 const _clientById = {};
+const _clientIdBySocket = new WeakMap();  // reverse index, may be stale and must be validated before use
 
-function purgeDeadClients()
-{
-    // Any clients that have been disconnected for too long are removed
-
-    const timeout = 30e3;
-
-    const clientIdsToRemove = [];
+const _reconnectTimeout = 30e3;    // clients disconnected for longer than this are removed
 
-    for (const [clientId, client] of Object.entries(_clientById))
+function onClientReconnectTimedOut(client)
+{
+    // Client may have been removed or replaced (same client ID) in the meantime
+    if (_clientById[client.clientId] !== client)
     {
-        const duration = client.getDisconnectedDuration();
-        if (duration > timeout)
-        {
-            console.log(`Scheduling clientId=${clientId} for removal because it has been disconnected for ${duration/1000} seconds`);
-            clientIdsToRemove.push(clientId);
-        }
+        return;
     }
 
-    for (const clientId of clientIdsToRemove)
-    {
-        removeClient(clientId);
-    }
+    console.log(`Removing clientId=${client.clientId} because it has been disconnected for ${client.getDisconnectedDuration()/1000} seconds`);
+    removeClient(client.clientId);
 }
 
 function removeClient(clientId)
@@ -234,32 +259,32 @@ function removeClient(clientId)
     if (clientId in _clientById)
     {
         delete _clientById[clientId];
-        for (const session of Object.values(_sessionById))
-        {
-            removeClientFromSession(session, clientId);
-        }
+        removeClientFromCurrentSession(clientId);
         console.log(`ClientId ${clientId} disconnected. ${Object.keys(_clientById).length} remaining.`);
     }
 }
 
 function tryGetClientIdBySocket(socket)
 {
-    let clientId = null;
-
-    for (const [otherClientId, otherClient] of Object.entries(_clientById))
+    const clientId = _clientIdBySocket.get(socket);
+    const client = _clientById[clientId];
+    if (client && client.socket == socket)
     {
-        if  (socket == otherClient.socket)
-        {
-            clientId = otherClientId;
-        }
+        return clientId;
     }
-
-    return clientId;
+    return null;
 }
 
 function sendMessage(socket, msg)
 {
-    socket.send(JSON.stringify(msg));
+    sendSerializedMessage(socket, JSON.stringify(msg));
+}
+
+// Sends a message serialized to JSON, either as a string or as a UTF-8 encoded buffer. Buffers are
+// sent as-is, in a text frame.
+function sendSerializedMessage(socket, json)
+{
+    socket.send(json, { binary: false });
 }
 
 function sendMessageToClient(clientId, msg)
@@ -275,6 +300,24 @@ function sendMessageToClient(clientId, msg)
     }
 }
 
+// Sends the same message to multiple clients, serializing and UTF-8 encoding it only once
+function sendMessageToClients(clientIds, msg)
+{
+    const json = Buffer.from(JSON.stringify(msg));
+    for (const clientId of clientIds)
+    {
+        const client = _clientById[clientId];
+        if (client)
+        {
+            client.sendSerializedMessage(json);
+        }
+        else
+        {
+            console.log(`Error: Cannot send message because no client exists for clientId=${clientId}`);
+        }
+    }
+}
+
 function onSocketClosed(socket)
 {
     // On a disconnect, we don't actually purge the client in case it tries to later reconnect.
@@ -347,14 +390,11 @@ function onStartNewGameMessage(socket, msg)
 
     // Remove client from other sessions (should not be necessary but in case there is some issue
     // with detecting socket disconnects, etc.)
-    for (const [_, session] of Object.entries(_sessionById))
-    {
-        removeClientFromSession(session, msg.clientId);
-    }
+    removeClientFromCurrentSession(msg.clientId);
 
     // Create session
-    const session = new Session(sessionId, sendMessageToClient, terminateSession, _imageGenerator);
-    session.tryAddClientIfAccepting(msg.clientId);
+    const session = new Session(sessionId, sendMessageToClient, sendMessageToClients, terminateSession, _imageGenerator);
+    tryAddClientToSession(session, msg.clientId);
     _sessionById[sessionId] = session;
 
     sendMessage(socket, new GameStartingStateMessage(sessionId));
@@ -381,14 +421,11 @@ function onJoinGameMessage(socket, msg)
     {
         // Remove client from other sessions (should not be necessary but in case there is some issue
         // with detecting socket disconnects, etc.)
-        for (const [_, session] of Object.entries(_sessionById))
-        {
-            removeClientFromSession(session, msg.clientId);
-        }
+        removeClientFromCurrentSession(msg.clientId);
 
         // Add client to session
         const session = _sessionById[msg.sessionId];
-        if (session.tryAddClientIfAccepting(msg.clientId))
+        if (tryAddClientToSession(session, msg.clientId))
         {
             session.sendMessage(new SelectGameStateMessage(msg.sessionId));
         }
@@ -479,7 +516,9 @@ function onClientInputMessage(socket, msg)
 
     try
     {
-        console.log(`Client clientId=${clientId} sent input: ${JSON.stringify(msg.inputs)}`);
+        // Inputs may contain entire base64-encoded drawings, which are abbreviated
+        const abbreviateLongStrings = (key, value) => (typeof(value) === "string" && value.length > 256) ? `<${value.length} characters>` : value;
+        console.log(`Client clientId=${clientId} sent input: ${JSON.stringify(msg.inputs, abbreviateLongStrings)}`);
     }
     catch (error)
     {
@@ -531,22 +570,40 @@ function processCommandLine()
 const options = processCommandLine();
 
 // Image generation handler
-const _imageGenerator = new ImageGenerator(_sessionById, options.useLocalImageServer);
+const _imageGenerator = new ImageGenerator(tryGetSessionByClientId, options.useLocalImageServer);
 
 // Web server
 const port = 8080;
 const app = express();
+app.use(serveCompressedAssets("../frontend"));
 app.use(express.static("../frontend"));
 const server = app.listen(port, () =>
 {
     console.log(`Laughprop web server listening on port ${port}`);
 });
 
-// Socket
-const wsServer = new WebSocketServer({ server: server });
+// Socket. Messages are small JSON objects except for drawings, which are base64-encoded 512x512
+// images, so compression is not worth its CPU cost and the payload limit need not be large.
+const pingInterval = 5e3;
+const maxMissedPongs = 4;   // unresponsive sockets are terminated after this many unanswered pings
+const wsServer = new WebSocketServer({ server: server, perMessageDeflate: false, maxPayload: 4 * 1024 * 1024 });
 wsServer.on('connection', socket =>
 {
-    let interval = setInterval(() => socket.ping(), 5e3);
+    // A peer that vanishes without closing the connection would otherwise go unnoticed until TCP
+    // gives up, which can take many minutes
+    let missedPongs = 0;
+    socket.on('pong', () => { missedPongs = 0; });
+    let interval = setInterval(() =>
+    {
+        if (missedPongs >= maxMissedPongs)
+        {
+            console.log(`Terminating unresponsive connection after ${missedPongs} unanswered pings`);
+            socket.terminate();
+            return;
+        }
+        missedPongs++;
+        socket.ping();
+    }, pingInterval);
     socket.on('message', function(buffer) { onMessageReceived(socket, buffer) });
     socket.onclose = function(event)
     {
@@ -563,5 +620,36 @@ wsServer.on('connection', socket =>
     };
 });
 
-// Periodic task to clean up disconnected clients
-setInterval(purgeDeadClients, 5e3);
\ No newline at end of file
+// Shut down gracefully, letting clients know the server is going away rather than having their
+// connections simply drop. Connections that do not close in time (e.g., a client that never
+// completes the close handshake) are not waited on indefinitely, and a second signal exits
+// immediately.
+const shutdownTimeout = 5e3;
+let shuttingDown = false;
+
+function shutdown(signal)
+{
+    if (shuttingDown)
+    {
+        console.log(`Received ${signal} while shutting down. Exiting immediately.`);
+        process.exit(1);
+    }
+    shuttingDown = true;
+
+    console.log(`Received ${signal}. Shutting down...`);
+    setTimeout(() =>
+    {
+        console.log(`Error: Connections still open after ${shutdownTimeout / 1000} seconds. Exiting anyway.`);
+        process.exit(1);
+    }, shutdownTimeout).unref();
+
+    for (const socket of wsServer.clients)
+    {
+        socket.close(1001, "Server shutdown");  // 1001 = going away
+    }
+    wsServer.close();
+    server.close(() => process.exit(0));
+}
+
+process.on("SIGINT", shutdown);
+process.on("SIGTERM", shutdown);
@@ -0,0 +1,148 @@
+/**
+ ** Laughprop
+ ** A Stable Diffusion Party Game
+ ** Copyright 2023 Bart Trzynadlowski, Steph Ng
+ **
+ ** This file is part of Laughprop.
+ **
+ ** Laughprop is free software: you can redistribute it and/or modify it under
+ ** the terms of the GNU General Public License as published by the Free
+ ** Software Foundation, either version 3 of the License, or (at your option)
+ ** any later version.
+ **
+ ** Laughprop is distributed in the hope that it will be useful, but WITHOUT
+ ** ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+ ** FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+ ** more details.
+ **
+ ** You should have received a copy of the GNU General Public License along
+ ** with Laughprop.  If not, see <http://www.gnu.org/licenses/>.
+ **/
+
+/*
+ * compressed_assets.mjs
+ *
+ * Express middleware that serves the text files (HTML, CSS, JavaScript) of a static directory
+ * gzip-compressed from memory. Files are read and compressed at startup and again only when they
+ * change on disk (as detected by modification time and size), so that requests cost a stat but
+ * neither disk reads nor compression. Anything else, including files added after startup, as well
+ * as requests from clients that do not accept gzip, falls through to the next handler (e.g.,
+ * express.static).
+ */
+
+import crypto from "crypto";
+import fs from "fs";
+import path from "path";
+import zlib from "zlib";
+
+const _contentTypeByExtension =
+{
+    ".html": "text/html; charset=UTF-8",
+    ".css":  "text/css; charset=UTF-8",
+    ".js":   "application/javascript; charset=UTF-8",
+    ".mjs":  "application/javascript; charset=UTF-8"
+};
+
+class CompressedAsset
+{
+    filepath;
+    contentType;
+    etag;
+    gzipped;    // Buffer
+
+    _mtimeMs = null;    // modification time and size of file when it was last loaded
+    _size = null;
+
+    // Reloads the file if it has changed since it was last loaded. Throws if it cannot be read.
+    update(stats)
+    {
+        if (stats.mtimeMs == this._mtimeMs && stats.size == this._size)
+        {
+            return;
+        }
+
+        this.gzipped = zlib.gzipSync(fs.readFileSync(this.filepath), { level: zlib.constants.Z_BEST_COMPRESSION });
+        this.etag = "\"" + crypto.createHash("sha1").update(this.gzipped).digest("base64") + "\"";  // must differ from uncompressed file's
+        this._mtimeMs = stats.mtimeMs;
+        this._size = stats.size;
+    }
+
+    constructor(filepath, contentType)
+    {
+        this.filepath = filepath;
+        this.contentType = contentType;
+        this.update(fs.statSync(filepath));
+    }
+}
+
+function loadCompressedAssets(rootDir, urlPath, assetByUrlPath)
+{
+    for (const entry of fs.readdirSync(rootDir, { withFileTypes: true }))
+    {
+        const filepath = path.join(rootDir, entry.name);
+        const fileUrlPath = urlPath + entry.name;
+        if (entry.isDirectory())
+        {
+            loadCompressedAssets(filepath, fileUrlPath + "/", assetByUrlPath);
+        }
+        else if (entry.isFile())
+        {
+            const contentType = _contentTypeByExtension[path.extname(entry.name).toLowerCase()];
+            if (contentType)
+            {
+                const asset = new CompressedAsset(filepath, contentType);
+                assetByUrlPath.set(fileUrlPath, asset);
+                if (entry.name == "index.html")
+                {
+                    assetByUrlPath.set(urlPath, asset);
+                }
+            }
+        }
+    }
+}
+
+// Returns middleware serving the compressible files under rootDir
+function serveCompressedAssets(rootDir)
+{
+    const assetByUrlPath = new Map();
+    loadCompressedAssets(rootDir, "/", assetByUrlPath);
+
+    return (req, res, next) =>
+    {
+        const asset = (req.method == "GET" || req.method == "HEAD") ? assetByUrlPath.get(req.path) : undefined;
+        if (!asset || !req.acceptsEncodings("gzip"))
+        {
+            next();
+            return;
+        }
+
+        fs.stat(asset.filepath, (error, stats) =>
+        {
+            try
+            {
+                if (error)
+                {
+                    throw error;
+                }
+                asset.update(stats);
+            }
+            catch (error)
+            {
+                // File was removed or could not be read, let the next handler deal with it
+                next();
+                return;
+            }
+
+            // ETag is set here so that send() does not hash the body on every request
+            res.set({
+                "Content-Type": asset.contentType,
+                "Content-Encoding": "gzip",
+                "ETag": asset.etag,
+                "Vary": "Accept-Encoding"
+            });
+            res.send(asset.gzipped);
+        });
+    };
+}
+
+export { serveCompressedAssets }
@@ -77,6 +77,9 @@ class Game
     // Method to send message to a client: sendMessage(clientId, msg)
     _sendMessageToClientFn;
 
+    // Method to send the same message to multiple clients: sendMessageToClients(clientIds, msg)
+    _sendMessageToClientsFn;
+
     // Image generator reference
     _imageGenerator;
 
@@ -354,10 +357,7 @@ class Game
         if (clientId == null || forceSendToAll)
         {
             // Send to all clients
-            for (const clientId of this._clientIds)
-            {
-                this._sendMessageToClientFn(clientId, msg);
-            }
+            this._sendMessageToClientsFn(this._clientIds, msg);
         }
         else
         {
@@ -657,16 +657,18 @@ class Game
         const mapOut = {};
         const mapIn = this._expandStateVar(clientId, op.stateVar);
 
-        // Validate
-        if (Object.keys(mapIn).length != (new Set(Object.values(mapIn))).size)
+        // Invert, validating uniqueness in the same pass: a value seen twice means the mapping
+        // cannot be safely inverted
+        let isUnique = true;
+        for (const [key, value] of Object.entries(mapIn))
         {
-            console.log(`Error: Cannot safely invert map ${op.stateVar} because mapping of keys to values is not unique: ${mapIn}`);
+            isUnique &&= !Object.hasOwn(mapOut, value);
+            mapOut[value] = key;
         }
 
-        // Invert
-        for (const [key, value] of Object.entries(mapIn))
+        if (!isUnique)
         {
-            mapOut[value] = key;
+            console.log(`Error: Cannot safely invert map ${op.stateVar} because mapping of keys to values is not unique: ${mapIn}`);
         }
 
         this._writeToStateVar(clientId, op.writeToStateVar, mapOut);
@@ -698,11 +700,12 @@ class Game
         return true;
     }
 
-    constructor(ops, clientIds, sendMessageToClientFn, imageGenerator)
+    constructor(ops, clientIds, sendMessageToClientFn, sendMessageToClientsFn, imageGenerator)
     {
         this._globalScriptCtx = new ScriptingContext(ops);
         this._clientIds = clientIds;
         this._sendMessageToClientFn = sendMessageToClientFn;
+        this._sendMessageToClientsFn = sendMessageToClientsFn;
         this._imageGenerator = imageGenerator;
     }
 }
@@ -31,6 +31,87 @@ import http from "http";
 import fs from "fs";
 import { randomChoice } from "./utils.mjs";
 
+// Default request payloads for the stable-diffusion-webui API. These are shared by all requests
+// and must not be modified: copy them and then override individual parameters.
+const _txt2ImgDefaultPayload = Object.freeze({
+    "enable_hr": false,
+    "hr_scale" : 2,
+    "hr_upscaler" : "Latent",
+    "hr_second_pass_steps" : 0,
+    "hr_resize_x": 0,
+    "hr_resize_y": 0,
+    "denoising_strength": 0.0,
+    "firstphase_width": 0,
+    "firstphase_height": 0,
+    "prompt": "",
+    "styles": [],
+    "seed": -1,
+    "subseed": -1,
+    "subseed_strength": 0.0,
+    "seed_resize_from_h": -1,
+    "seed_resize_from_w": -1,
+    "batch_size": 1,
+    "n_iter": 1,
+    "steps": 20,
+    "cfg_scale": 7.0,
+    "width": 512,
+    "height": 512,
+    "restore_faces": false,
+    "tiling": false,
+    "negative_prompt": "",
+    "eta": 0,
+    "s_churn": 0,
+    "s_tmax": 0,
+    "s_tmin": 0,
+    "s_noise": 1,
+    "override_settings": {},
+    "override_settings_restore_afterwards": true,
+    "sampler_name": "Euler a",
+    "sampler_index": "Euler a",
+    "script_name": null,
+    "script_args": []
+});
+
+const _img2ImgDefaultPayload = Object.freeze({
+    "resize_mode": 0,
+    "denoising_strength": 0.75,
+    "mask_blur": 4,
+    "inpainting_fill": 0,
+    "inpaint_full_res": true,
+    "inpaint_full_res_padding": 0,
+    "inpainting_mask_invert": 0,
+    "initial_noise_multiplier": 1,
+    "prompt": "",
+    "styles": [],
+    "seed": -1,
+    "subseed": -1,
+    "subseed_strength": 0,
+    "seed_resize_from_h": -1,
+    "seed_resize_from_w": -1,
+    "batch_size": 1,
+    "n_iter": 1,
+    "steps": 20,
+    "cfg_scale": 7.0,
+    "image_cfg_scale": 1.5,
+    "width": 512,
+    "height": 512,
+    "restore_faces": false,
+    "tiling": false,
+    "negative_prompt": "",
+    "eta": 0,
+    "s_churn": 0,
+    "s_tmax": 0,
+    "s_tmin": 0,
+    "s_noise": 1,
+    "override_settings": {},
+    "override_settings_restore_afterwards": true,
+    "sampler_name": "Euler a",
+    "sampler_index": "Euler a",
+    "include_init_images": false,
+    "script_name": null,
+    "script_args": []
+});
+
 class Txt2ImgRequest
 {
     // Common to all request objects
@@ -117,6 +198,8 @@ class ImageServer
     port;
     imageRequestsPending = [];
     imageRequestInProgress = null;
+    loadedModel = null;                 // last model checkpoint known to be loaded (null if unknown)
+    agent;                              // HTTP agent keeping connections to this server alive
 
     enqueue(imageRequest)
     {
@@ -130,6 +213,12 @@ class ImageServer
         return this.imageRequestInProgress != null;
     }
 
+    // Number of requests pending plus the one in progress, if any
+    numRequestsOutstanding()
+    {
+        return this.imageRequestsPending.length + (this.isBusy() ? 1 : 0);
+    }
+
     finishRequest(imageRequest)
     {
         if (this.imageRequestInProgress != imageRequest)
@@ -146,20 +235,30 @@ class ImageServer
     {
         this.host = host;
         this.port = port;
+        this.agent = new http.Agent({ keepAlive: true });
     }
 }
 
 class ImageGenerator
 {
-    _sessionById;   // reference to sessions table (session indexed by session ID)
+    _tryGetSessionByClientIdFn; // tryGetSessionByClientId(clientId), returns session or null
 
     _placeholderImages = [];
     _inputImageByAssetPath = {};
 
+    // Recently generated images by request parameters, in least- to most-recently used order.
+    // Requests are made with fixed seeds, so identical parameters produce identical images.
+    // Bounded by total size rather than entry count: each entry holds a batch of full base64 PNGs
+    // (around 0.5 MB apiece), so the budget below amounts to only a handful of recent requests.
+    _cachedImagesByRequestKey = new Map();
+    _cachedImageBytes = 0;                      // total length of all cached base64 image strings
+    _maxCachedImageBytes = 16 * 1024 * 1024;
+
     // Image servers (by default only a single local server)
     _imageServers = [ new ImageServer("127.0.0.1", 7860) ];
     _txt2ImgModel = "v1-5-pruned-emaonly.safetensors";
     _depth2ImgModel = "512-depth-ema.ckpt";
+    _requestTimeout = 180e3;    // milliseconds of inactivity before a request to an image server is abandoned
 
 
     makeTxt2ImgRequest(clientId, params, destStateVar)
@@ -173,6 +272,10 @@ class ImageGenerator
 
         // Initial request attempt
         const imageRequest = new Txt2ImgRequest(clientId, session, params, destStateVar);
+        if (this._tryRespondFromCache(imageRequest))
+        {
+            return;
+        }
         this._dispatchImageRequestToServer(imageRequest);
         this._tryProcessNextRequest();
     }
@@ -187,6 +290,10 @@ class ImageGenerator
         }
 
         const imageRequest = new Depth2ImgRequest(clientId, session, params, destStateVar);
+        if (this._tryRespondFromCache(imageRequest))
+        {
+            return;
+        }
         this._dispatchImageRequestToServer(imageRequest);
         this._tryProcessNextRequest();
     }
@@ -201,22 +308,97 @@ class ImageGenerator
         }
 
         const imageRequest = new Sketch2ImgRequest(clientId, session, prompt, inputImageBase64, destStateVar);
+        if (this._tryRespondFromCache(imageRequest))
+        {
+            return;
+        }
         this._dispatchImageRequestToServer(imageRequest);
         this._tryProcessNextRequest();
     }
 
     _tryGetSessionByClientId(clientId)
     {
-        for (const [_, session] of Object.entries(this._sessionById))
+        return this._tryGetSessionByClientIdFn(clientId);
+    }
+
+    // Returns a key identifying the request parameters or null if the request is not cacheable.
+    // Sketches are unique drawings and are not worth caching.
+    _getRequestCacheKey(imageRequest)
+    {
+        if (imageRequest instanceof Txt2ImgRequest)
         {
-            if (session.hasClient(clientId))
-            {
-                return session;
-            }
+            return JSON.stringify([ "txt2img", imageRequest.params.prompt, imageRequest.params.negativePrompt ]);
+        }
+        else if (imageRequest instanceof Depth2ImgRequest)
+        {
+            return JSON.stringify([ "depth2img", imageRequest.params.image, imageRequest.params.prompt, imageRequest.params.negativePrompt ]);
         }
         return null;
     }
 
+    _cacheImages(imageRequest, images)
+    {
+        const key = this._getRequestCacheKey(imageRequest);
+        if (key == null)
+        {
+            return;
+        }
+
+        const numBytes = images.reduce((total, image) => total + image.length, 0);
+        if (numBytes > this._maxCachedImageBytes)
+        {
+            return;
+        }
+
+        this._uncacheImages(key);
+        this._cachedImagesByRequestKey.set(key, images);
+        this._cachedImageBytes += numBytes;
+
+        // Evict least recently used until within budget
+        while (this._cachedImageBytes > this._maxCachedImageBytes)
+        {
+            this._uncacheImages(this._cachedImagesByRequestKey.keys().next().value);
+        }
+    }
+
+    _uncacheImages(key)
+    {
+        const images = this._cachedImagesByRequestKey.get(key);
+        if (images)
+        {
+            this._cachedImagesByRequestKey.delete(key);
+            this._cachedImageBytes -= images.reduce((total, image) => total + image.length, 0);
+        }
+    }
+
+    // If images for identical request parameters were generated recently, responds with those
+    // (under new UUIDs) and returns true
+    _tryRespondFromCache(imageRequest)
+    {
+        const key = this._getRequestCacheKey(imageRequest);
+        const images = key != null ? this._cachedImagesByRequestKey.get(key) : undefined;
+        if (!images)
+        {
+            return false;
+        }
+
+        // Mark as most recently used
+        this._cachedImagesByRequestKey.delete(key);
+        this._cachedImagesByRequestKey.set(key, images);
+
+        const imageByUuid = {};
+        for (const image of images)
+        {
+            imageByUuid[crypto.randomUUID()] = image;
+        }
+
+        // Respond asynchronously, as a server would, because the game script that made the
+        // request is still executing
+        console.log("Responding to image request with cached images");
+        setImmediate(() => imageRequest.session.receiveImageResponse(imageRequest.clientId, imageRequest.destStateVar, imageByUuid));
+        return true;
+    }
+
     _loadInputImage(assetPath)
     {
         if (assetPath in this._inputImageByAssetPath)
@@ -231,16 +413,44 @@ class ImageGenerator
         return base64;
     }
 
-    _getImageServerOptions(imageRequest, onOptions)
+    // Reads the image server's options. onFailed(error) is called instead of onOptions(options) if
+    // the server cannot be reached or does not respond in time.
+    _getImageServerOptions(imageRequest, onOptions, onFailed)
     {
         const url = "http://" + imageRequest.imageServer.host + ":" + imageRequest.imageServer.port + "/sdapi/v1/options";
-        http.get(url, response =>
+
+        let finished = false;
+
+        function onError(error)
+        {
+            if (!finished)
+            {
+                finished = true;
+                console.log("Error: Image server options read request failed");
+                console.log(error);
+                onFailed(error);
+            }
+        }
+
+        const request = http.get(url, { agent: imageRequest.imageServer.agent }, response =>
         {
-            response.on("data", data =>
+            const chunks = [];
+            response.on("data", chunk =>
+            {
+                chunks.push(chunk);
+            });
+            response.on("error", onError);
+            response.on("end", () =>
             {
+                if (finished)
+                {
+                    return;
+                }
+                finished = true;
+
                 try
                 {
-                    onOptions(JSON.parse(data));
+                    onOptions(JSON.parse(Buffer.concat(chunks).toString()));
                 }
                 catch (error)
                 {
@@ -249,15 +459,14 @@ class ImageGenerator
                     onOptions({});
                 }
             });
-        }).on("error", error =>
-        {
-            console.log("Error: Image server options read request failed");
-            console.log(error);
-            onOptions({});
         });
+        request.setTimeout(this._requestTimeout, () => request.destroy(new Error(`No response from image server in ${this._requestTimeout / 1000} seconds`)));
+        request.on("error", onError);
     }
 
-    _setImageModel(imageRequest, model, onComplete)
+    // Sets the image server's model. onFailed(error) is called instead of onComplete() if the
+    // server cannot be reached or does not respond in time.
+    _setImageModel(imageRequest, model, onComplete, onFailed)
     {
         console.log(`Setting image model: ${model}`);
 
@@ -269,126 +478,164 @@ class ImageGenerator
         const urlParams = {
             host: imageRequest.imageServer.host,
             port: imageRequest.imageServer.port,
+            agent: imageRequest.imageServer.agent,
             path: "/sdapi/v1/options",
             method: "POST",
             headers: { "Content-Type": "application/json" }
         };
 
-        const request = http.request(urlParams, _ => onComplete());
+        let finished = false;
+
+        const request = http.request(urlParams, response =>
+        {
+            response.resume();  // body is not needed but must be drained for the connection to be reused
+            if (!finished)
+            {
+                finished = true;
+                if (response.statusCode >= 200 && response.statusCode < 300)
+                {
+                    imageRequest.imageServer.loadedModel = model;
+                }
+                else
+                {
+                    console.log(`Error: Model set request failed with status ${response.statusCode}`);
+                    imageRequest.imageServer.loadedModel = null;
+                }
+                onComplete();
+            }
+        });
+        request.setTimeout(this._requestTimeout, () => request.destroy(new Error(`No response from image server in ${this._requestTimeout / 1000} seconds`)));
         request.on("error", error =>
         {
-            console.log(`Error: Model set request failed`);
-            console.log(error);
-            onComplete();
+            if (!finished)
+            {
+                finished = true;
+                console.log(`Error: Model set request failed`);
+                console.log(error);
+                imageRequest.imageServer.loadedModel = null;
+                onFailed(error);
+            }
         });
 
         request.write(JSON.stringify(options));
         request.end();
     }
 
-    _processTxt2ImgRequest(imageRequest)
+    // Ensures the image server has the given model loaded before proceeding. The model last
+    // loaded on each server is remembered so that the options query can be skipped when it is
+    // already known to be correct.
+    _ensureImageModel(imageRequest, model, onReady)
     {
-        imageRequest.imageServer.imageRequestInProgress = imageRequest;
+        const imageServer = imageRequest.imageServer;
+        if (imageServer.loadedModel == model)
+        {
+            onReady();
+            return;
+        }
 
         const self = this;
 
+        // A server that cannot be reached or has stopped responding will not do any better with
+        // the generation request itself, so move on to the next server right away
+        function onFailed(error)
+        {
+            imageServer.loadedModel = null;  // server may have restarted
+            self._finishImageRequest(imageRequest, imageServer, true);
+        }
+
         this._getImageServerOptions(imageRequest, options =>
         {
-            const model = options["sd_model_checkpoint"];
-            if (self._txt2ImgModel != model)
+            if (options["sd_model_checkpoint"] != model)
             {
-                self._setImageModel(imageRequest, self._txt2ImgModel, () => self._continueTxt2ImgRequest(imageRequest));
+                self._setImageModel(imageRequest, model, onReady, onFailed);
             }
             else
             {
-                self._continueTxt2ImgRequest(imageRequest);
+                imageServer.loadedModel = model;
+                onReady();
             }
-        });
+        }, onFailed);
     }
 
-    _continueTxt2ImgRequest(imageRequest)
+    // Finishes an image request on the given server, dispatching it to the next server if it is to
+    // be retried, and moves on to the next pending request
+    _finishImageRequest(imageRequest, imageServer, retry)
+    {
+        imageServer.finishRequest(imageRequest);
+        if (retry)
+        {
+            this._dispatchImageRequestToServer(imageRequest);   // try next
+        }
+        setImmediate(() => this._tryProcessNextRequest());
+    }
+
+    // Posts an image generation request to the image server it has been assigned to and delivers
+    // the resulting images to the session. A request that fails for any reason -- connection
+    // error, no activity for too long, or the connection dropping mid-response -- is finished on
+    // that server exactly once and dispatched to the next one, so that a misbehaving server can
+    // never leave its queue stalled behind a request that will not complete.
+    _postImageRequest(imageRequest, path, payload, requestType)
     {
         const self = this;
 
         const clientId = imageRequest.clientId;
         const session = imageRequest.session;
-        const params = imageRequest.params;
         const destStateVar = imageRequest.destStateVar;
+        const imageServer = imageRequest.imageServer;
 
-        // Defaults
-        const payload = {
-            "enable_hr": false,
-            "hr_scale" : 2,
-            "hr_upscaler" : "Latent",
-            "hr_second_pass_steps" : 0,
-            "hr_resize_x": 0,
-            "hr_resize_y": 0,
-            "denoising_strength": 0.0,
-            "firstphase_width": 0,
-            "firstphase_height": 0,
-            "prompt": "",
-            "styles": [],
-            "seed": -1,
-            "subseed": -1,
-            "subseed_strength": 0.0,
-            "seed_resize_from_h": -1,
-            "seed_resize_from_w": -1,
-            "batch_size": 1,
-            "n_iter": 1,
-            "steps": 20,
-            "cfg_scale": 7.0,
-            "width": 512,
-            "height": 512,
-            "restore_faces": false,
-            "tiling": false,
-            "negative_prompt": "",
-            "eta": 0,
-            "s_churn": 0,
-            "s_tmax": 0,
-            "s_tmin": 0,
-            "s_noise": 1,
-            "override_settings": {},
-            "override_settings_restore_afterwards": true,
-            "sampler_name": "Euler a",
-            "sampler_index": "Euler a",
-            "script_name": null,
-            "script_args": []
-        };
-
-        // Our params
-        payload["prompt"] = params.prompt;
-        payload["negative_prompt"] = params.negativePrompt;
-        payload["seed"] = 42;
-        payload["cfg_scale"] = 9;   // 7?
-        // payload["steps"] = 40;
-        payload["batch_size"] = imageRequest.batchSize;
-        payload["n_iter"] = imageRequest.numIterations;
-
-        // Post request
         const urlParams = {
-            host: imageRequest.imageServer.host,
-            port: imageRequest.imageServer.port,
-            path: "/sdapi/v1/txt2img",
+            host: imageServer.host,
+            port: imageServer.port,
+            agent: imageServer.agent,
+            path: path,
             method: "POST",
             headers: { "Content-Type": "application/json" }
         };
 
+        let finished = false;
+
+        function finishRequest(retry)
+        {
+            finished = true;
+            self._finishImageRequest(imageRequest, imageServer, retry);
+        }
+
+        function onError(error)
+        {
+            if (finished)
+            {
+                return;
+            }
+
+            console.log(`Error: ${requestType} request failed on ${imageServer.host}:${imageServer.port}`);
+            console.log(error);
+            imageServer.loadedModel = null;  // server may have restarted
+            finishRequest(true);
+        }
+
         function onResponse(response)
         {
-            let data = "";
+            // Accumulate raw chunks and decode once, rather than growing a string per chunk
+            const chunks = [];
             response.on("data", (chunk) =>
             {
-                data += chunk;
+                chunks.push(chunk);
             });
+            response.on("error", onError);  // connection dropped before response was complete
             response.on("end", () =>
             {
+                if (finished)
+                {
+                    return;
+                }
+
                 let retry = false;
                 try
                 {
-                    const responseObj = JSON.parse(data);
+                    const responseObj = JSON.parse(Buffer.concat(chunks).toString());
                     if (!responseObj["images"])
                     {
-                        console.log(`Error: Did not receive any images from ${imageRequest.imageServer.host}:${imageRequest.imageServer.port}`);
+                        console.log(`Error: Did not receive any images from ${imageServer.host}:${imageServer.port}`);
                         retry = true;
                     }
                     else
@@ -409,116 +656,76 @@ class ImageGenerator
                         }
 
                         // Return
+                        self._cacheImages(imageRequest, Object.values(imageByUuid));
                         session.receiveImageResponse(clientId, destStateVar, imageByUuid);
                     }
                 }
                 catch (error)
                 {
-                    console.log(`Error: Unable to parse response from image server ${imageRequest.imageServer.host}:${imageRequest.imageServer.port}`);
+                    console.log(`Error: Unable to parse response from image server ${imageServer.host}:${imageServer.port}`);
                     console.log(error);
                     retry = true;
                 }
                 finally
                 {
-                    // Finish request!
-                    imageRequest.imageServer.finishRequest(imageRequest);
-                    setTimeout(() => self._tryProcessNextRequest(), 0);
-                }
+                    if (retry)
+                    {
+                        imageServer.loadedModel = null;  // server is misbehaving, do not trust what it has loaded
+                    }
 
-                if (retry)
-                {
-                    self._dispatchImageRequestToServer(imageRequest);
+                    // Finish request!
+                    finishRequest(retry);
                 }
             });
         }
 
         const request = http.request(urlParams, onResponse);
-        request.on("error", error =>
-        {
-            console.log(`Error: txt2img request failed on ${imageRequest.imageServer.host}:${imageRequest.imageServer.port}`);
-            console.log(error);
-
-            // Finish request and dispatch again
-            imageRequest.imageServer.finishRequest(imageRequest);
-            self._dispatchImageRequestToServer(imageRequest);   // try next
-            setTimeout(() => self._tryProcessNextRequest(), 0);
-        });
+        request.setTimeout(this._requestTimeout, () => request.destroy(new Error(`No response from image server in ${this._requestTimeout / 1000} seconds`)));
+        request.on("error", onError);
         request.write(JSON.stringify(payload));
         request.end();
     }
 
-    _processDepth2ImgRequest(imageRequest)
+    _processTxt2ImgRequest(imageRequest)
     {
         imageRequest.imageServer.imageRequestInProgress = imageRequest;
+        this._ensureImageModel(imageRequest, this._txt2ImgModel, () => this._continueTxt2ImgRequest(imageRequest));
+    }
 
-        const self = this;
+    _continueTxt2ImgRequest(imageRequest)
+    {
+        const params = imageRequest.params;
 
-        this._getImageServerOptions(imageRequest, options =>
-        {
-            const model = options["sd_model_checkpoint"];
-            if (self._depth2ImgModel != model)
-            {
-                self._setImageModel(imageRequest, self._depth2ImgModel, () => self._continueDepth2ImgRequest(imageRequest));
-            }
-            else
-            {
-                self._continueDepth2ImgRequest(imageRequest);
-            }
-        });
+        // Defaults
+        const payload = { ..._txt2ImgDefaultPayload };
+
+        // Our params
+        payload["prompt"] = params.prompt;
+        payload["negative_prompt"] = params.negativePrompt;
+        payload["seed"] = 42;
+        payload["cfg_scale"] = 9;   // 7?
+        // payload["steps"] = 40;
+        payload["batch_size"] = imageRequest.batchSize;
+        payload["n_iter"] = imageRequest.numIterations;
+
+        this._postImageRequest(imageRequest, "/sdapi/v1/txt2img", payload, "txt2img");
     }
 
-    _continueDepth2ImgRequest(imageRequest)
+    _processDepth2ImgRequest(imageRequest)
     {
-        const self = this;
+        imageRequest.imageServer.imageRequestInProgress = imageRequest;
+        this._ensureImageModel(imageRequest, this._depth2ImgModel, () => this._continueDepth2ImgRequest(imageRequest));
+    }
 
-        const clientId = imageRequest.clientId;
-        const session = imageRequest.session;
+    _continueDepth2ImgRequest(imageRequest)
+    {
         const params = imageRequest.params;
-        const destStateVar = imageRequest.destStateVar;
 
         // Defaults
-        const payload = {
-            "init_images": [ this._loadInputImage(params.image) ],
-            "resize_mode": 0,
-            "denoising_strength": 0.75,
-            "mask_blur": 4,
-            "inpainting_fill": 0,
-            "inpaint_full_res": true,
-            "inpaint_full_res_padding": 0,
-            "inpainting_mask_invert": 0,
-            "initial_noise_multiplier": 1,
-            "prompt": "",
-            "styles": [],
-            "seed": -1,
-            "subseed": -1,
-            "subseed_strength": 0,
-            "seed_resize_from_h": -1,
-            "seed_resize_from_w": -1,
-            "batch_size": 1,
-            "n_iter": 1,
-            "steps": 20,
-            "cfg_scale": 7.0,
-            "image_cfg_scale": 1.5,
-            "width": 512,
-            "height": 512,
-            "restore_faces": false,
-            "tiling": false,
-            "negative_prompt": "",
-            "eta": 0,
-            "s_churn": 0,
-            "s_tmax": 0,
-            "s_tmin": 0,
-            "s_noise": 1,
-            "override_settings": {},
-            "override_settings_restore_afterwards": true,
-            "sampler_name": "Euler a",
-            "sampler_index": "Euler a",
-            "include_init_images": false,
-            "script_name": null,
-            "script_args": []
-        };
+        const payload = { ..._img2ImgDefaultPayload };
 
         // Our params
+        payload["init_images"] = [ this._loadInputImage(params.image) ];
         payload["prompt"] = params.prompt;
         payload["negative_prompt"] = params.negativePrompt;
         payload["seed"] = 585501288;
@@ -533,159 +740,23 @@ class ImageGenerator
         payload["seed_resize_from_w"] = 0;
         payload["resize_mode"] = 0;
 
-        // Post request
-        const urlParams = {
-            host: imageRequest.imageServer.host,
-            port: imageRequest.imageServer.port,
-            path: "/sdapi/v1/img2img",
-            method: "POST",
-            headers: { "Content-Type": "application/json" }
-        };
-
-        function onResponse(response)
-        {
-            let data = "";
-            response.on("data", (chunk) =>
-            {
-                data += chunk;
-            });
-            response.on("end", () =>
-            {
-                let retry = false;
-                try
-                {
-                    const responseObj = JSON.parse(data);
-                    if (!responseObj["images"])
-                    {
-                        console.log(`Error: Did not receive any images from ${imageRequest.imageServer.host}:${imageRequest.imageServer.port}`);
-                        retry = true;
-                    }
-                    else
-                    {
-                        const numImagesExpected = payload["batch_size"] * payload["n_iter"];
-                        const numImages = Math.min(responseObj["images"].length, numImagesExpected);
-                        const imageByUuid = {};
-
-                        for (let i = 0; i < numImages; i++)
-                        {
-                            imageByUuid[crypto.randomUUID()] = responseObj["images"][i];
-                        }
-
-                        // This should never happen but in case it does, pad with the first image
-                        for (let i = numImages; i < numImagesExpected; i++)
-                        {
-                            imageByUuid[crypto.randomUUID()] = responseObj["images"][0];
-                        }
-
-                        // Return
-                        session.receiveImageResponse(clientId, destStateVar, imageByUuid);
-                    }
-                }
-                catch (error)
-                {
-                    console.log(`Error: Unable to parse response from image server ${imageRequest.imageServer.host}:${imageRequest.imageServer.port}`);
-                    console.log(error);
-                    retry = true;
-                }
-                finally
-                {
-                    // Finish request!
-                    imageRequest.imageServer.finishRequest(imageRequest);
-                    setTimeout(() => self._tryProcessNextRequest(), 0);
-                }
-
-                if (retry)
-                {
-                    self._dispatchImageRequestToServer(imageRequest);
-                }
-            });
-        }
-
-        const request = http.request(urlParams, onResponse);
-        request.on("error", error =>
-        {
-            console.log(`Error: depth2img request failed on ${imageRequest.imageServer.host}:${imageRequest.imageServer.port}`);
-            console.log(error);
-
-            // Finish request and dispatch again
-            imageRequest.imageServer.finishRequest(imageRequest);
-            self._dispatchImageRequestToServer(imageRequest);   // try next
-            setTimeout(() => self._tryProcessNextRequest(), 0);
-        });
-        request.write(JSON.stringify(payload));
-        request.end();
+        this._postImageRequest(imageRequest, "/sdapi/v1/img2img", payload, "depth2img");
     }
 
     _processSketch2ImgRequest(imageRequest)
     {
         imageRequest.imageServer.imageRequestInProgress = imageRequest;
-
-        const self = this;
-
-        this._getImageServerOptions(imageRequest, options =>
-        {
-            const model = options["sd_model_checkpoint"];
-            if (self._txt2ImgModel != model)
-            {
-                self._setImageModel(imageRequest, self._txt2ImgModel, () => self._continueSketch2ImgRequest(imageRequest));
-            }
-            else
-            {
-                self._continueSketch2ImgRequest(imageRequest);
-            }
-        });
+        this._ensureImageModel(imageRequest, this._txt2ImgModel, () => this._continueSketch2ImgRequest(imageRequest));
     }
 
     // Sketch2img is text2img/img2img plus ControlNet scribble mode
     _continueSketch2ImgRequest(imageRequest)
     {
-        const self = this;
-
-        const clientId = imageRequest.clientId;
-        const session = imageRequest.session;
         const prompt = imageRequest.prompt;
         const inputImageBase64 = imageRequest.inputImageBase64;
-        const destStateVar = imageRequest.destStateVar;
 
         // Defaults
-        const payload = {
-            "enable_hr": false,
-            "hr_scale" : 2,
-            "hr_upscaler" : "Latent",
-            "hr_second_pass_steps" : 0,
-            "hr_resize_x": 0,
-            "hr_resize_y": 0,
-            "denoising_strength": 0.0,
-            "firstphase_width": 0,
-            "firstphase_height": 0,
-            "prompt": "",
-            "styles": [],
-            "seed": -1,
-            "subseed": -1,
-            "subseed_strength": 0.0,
-            "seed_resize_from_h": -1,
-            "seed_resize_from_w": -1,
-            "batch_size": 1,
-            "n_iter": 1,
-            "steps": 20,
-            "cfg_scale": 7.0,
-            "width": 512,
-            "height": 512,
-            "restore_faces": false,
-            "tiling": false,
-            "negative_prompt": "",
-            "eta": 0,
-            "s_churn": 0,
-            "s_tmax": 0,
-            "s_tmin": 0,
-            "s_noise": 1,
-            "override_settings": {},
-            "override_settings_restore_afterwards": true,
-            "sampler_name": "Euler a",
-            "sampler_index": "Euler a",
-            "script_name": null,
-            "script_args": []
-        };
+        const payload = { ..._txt2ImgDefaultPayload };
 
         // Our params
         payload["prompt"] = prompt;
@@ -720,97 +791,33 @@ class ImageGenerator
             }
         };
 
-        // Post request
-        const urlParams = {
-            host: imageRequest.imageServer.host,
-            port: imageRequest.imageServer.port,
-            path: "/sdapi/v1/txt2img",
-            method: "POST",
-            headers: { "Content-Type": "application/json" }
-        };
-
-        function onResponse(response)
-        {
-            let data = "";
-            response.on("data", (chunk) =>
-            {
-                data += chunk;
-            });
-            response.on("end", () =>
-            {
-                let retry = false;
-                try
-                {
-                    const responseObj = JSON.parse(data);
-                    if (!responseObj["images"])
-                    {
-                        console.log(`Error: Did not receive any images from ${imageRequest.imageServer.host}:${imageRequest.imageServer.port}`);
-                        retry = true;
-                    }
-                    else
-                    {
-                        const numImagesExpected = payload["batch_size"] * payload["n_iter"];
-                        const numImages = Math.min(responseObj["images"].length, numImagesExpected);
-                        const imageByUuid = {};
-
-                        for (let i = 0; i < numImages; i++)
-                        {
-                            imageByUuid[crypto.randomUUID()] = responseObj["images"][i];
-                        }
-
-                        // This should never happen but in case it does, pad with the first image
-                        for (let i = numImages; i < numImagesExpected; i++)
-                        {
-                            imageByUuid[crypto.randomUUID()] = responseObj["images"][0];
-                        }
+        this._postImageRequest(imageRequest, "/sdapi/v1/txt2img", payload, "sketch2img");
+    }
 
-                        // Return
-                        session.receiveImageResponse(clientId, destStateVar, imageByUuid);
-                    }
-                }
-                catch (error)
-                {
-                    console.log(`Error: Unable to parse response from image server ${imageRequest.imageServer.host}:${imageRequest.imageServer.port}`);
-                    console.log(error);
-                    retry = true;
-                }
-                finally
-                {
-                    // Finish request!
-                    imageRequest.imageServer.finishRequest(imageRequest);
-                    setTimeout(() => self._tryProcessNextRequest(), 0);
-                }
+    _getImageModel(imageRequest)
+    {
+        return imageRequest instanceof Depth2ImgRequest ? this._depth2ImgModel : this._txt2ImgModel;
+    }
 
-                if (retry)
-                {
-                    self._dispatchImageRequestToServer(imageRequest);
-                }
-            });
+    // Returns the model an image server will have loaded once its queue has been processed
+    _getImageModelAfterQueue(imageServer)
+    {
+        const numPending = imageServer.imageRequestsPending.length;
+        if (numPending > 0)
+        {
+            return this._getImageModel(imageServer.imageRequestsPending[numPending - 1]);
         }
-
-        const request = http.request(urlParams, onResponse);
-        request.on("error", error =>
+        else if (imageServer.imageRequestInProgress != null)
         {
-            console.log(`Error: sketch2img request failed on ${imageRequest.imageServer.host}:${imageRequest.imageServer.port}`);
-            console.log(error);
-
-            // Finish request and dispatch again
-            imageRequest.imageServer.finishRequest(imageRequest);
-            self._dispatchImageRequestToServer(imageRequest);   // try next
-            setTimeout(() => self._tryProcessNextRequest(), 0);
-        });
-        request.write(JSON.stringify(payload));
-        request.end();
+            return this._getImageModel(imageServer.imageRequestInProgress);
+        }
+        return imageServer.loadedModel;
     }
 
     _dispatchImageRequestToServer(imageRequest)
     {
-        // Sort image servers in ascending order of queue size
-        const imageServers = this._imageServers.slice();
-        imageServers.sort((a, b) => a.imageRequestsPending.length - b.imageRequestsPending.length);
-
         // Sanity check: ensure no server already has this image request
-        for (const imageServer of imageServers)
+        for (const imageServer of this._imageServers)
         {
             if (imageServer.imageRequestInProgress == imageRequest || imageServer.imageRequestsPending.includes(imageRequest))
             {
@@ -819,18 +826,44 @@ class ImageGenerator
             }
         }
 
-        // Find the first server that has not yet been attempted for this image request
-        for (const imageServer of imageServers)
+        // Of the servers not yet attempted for this image request, pick the one with the fewest
+        // outstanding requests (including the one in progress, so that idle servers are preferred
+        // over busy ones with an empty queue). Ties are broken in favor of servers that will
+        // already have the required model loaded, avoiding a costly checkpoint reload, and then in
+        // favor of the server listed first.
+        const model = this._getImageModel(imageRequest);
+        let bestImageServer = null;
+        let bestNumRequestsOutstanding = Infinity;
+        let bestHasModel = false;
+        for (const imageServer of this._imageServers)
         {
-            if (!imageRequest.imageServersAttempted.has(imageServer))
+            if (imageRequest.imageServersAttempted.has(imageServer))
             {
-                // Found a server we have not yet tried. Dispatch to it.
-                imageServer.enqueue(imageRequest);
-                console.log(`Dispatched request to: ${imageServer.host}:${imageServer.port}`);
-                return;
+                continue;
+            }
+
+            const numRequestsOutstanding = imageServer.numRequestsOutstanding();
+            if (numRequestsOutstanding > bestNumRequestsOutstanding)
+            {
+                continue;
+            }
+
+            const hasModel = this._getImageModelAfterQueue(imageServer) == model;
+            if (numRequestsOutstanding < bestNumRequestsOutstanding || (hasModel && !bestHasModel))
+            {
+                bestImageServer = imageServer;
+                bestNumRequestsOutstanding = numRequestsOutstanding;
+                bestHasModel = hasModel;
             }
         }
 
+        if (bestImageServer != null)
+        {
+            bestImageServer.enqueue(imageRequest);
+            console.log(`Dispatched request to: ${bestImageServer.host}:${bestImageServer.port}`);
+            return;
+        }
+
         console.log(`Error: Image request failed across all servers`)
 
         // Dummy response using placeholder images
@@ -894,7 +927,25 @@ class ImageGenerator
         }
     }
 
-    constructor(sessionById, useLocalImageServer)
+    // Preloads the depth2img input images (found in subdirectories of the assets directory) so
+    // that they do not have to be read from disk, blocking the event loop, during requests
+    _preloadInputImages()
+    {
+        for (const entry of fs.readdirSync("../assets", { withFileTypes: true }))
+        {
+            if (!entry.isDirectory())
+            {
+                continue;
+            }
+
+            for (const filename of fs.readdirSync("../assets/" + entry.name))
+            {
+                this._loadInputImage(entry.name + "/" + filename);
+            }
+        }
+    }
+
+    constructor(tryGetSessionByClientIdFn, useLocalImageServer)
     {
         if (!useLocalImageServer)
         {
@@ -913,8 +964,9 @@ class ImageGenerator
             console.log(`  ${imageServer.host}:${imageServer.port}`);
         }
 
-        this._sessionById = sessionById;
+        this._tryGetSessionByClientIdFn = tryGetSessionByClientIdFn;
         this._loadRequiredImageAssets();
+        this._preloadInputImages();
     }
 }
 
@@ -36,6 +36,7 @@ class Session
 {
     _sessionId;
     _sendMessageToClientFn;     // sendMessage(clientId, msg);
+    _sendMessageToClientsFn;    // sendMessageToClients(clientIds, msg);
     _terminateSessionFn;        // terminateSession(session, gameInterruptedReason);
     _imageGenerator;            // image generator object
     _clientIds = new Set();     // set of clients
@@ -135,10 +136,7 @@ class Session
 
     sendMessage(msg)
     {
-        for (const clientId of this._clientIds)
-        {
-            this._sendMessageToClientFn(clientId, msg);
-        }
+        this._sendMessageToClientsFn(this._clientIds, msg);
     }
 
     _tryStartGame()
@@ -166,25 +164,26 @@ class Session
         {
         default:
         case "It's a Mood":
-            this._game = new Game(themed_image_game.script, this._clientIds, this._sendMessageToClientFn, this._imageGenerator);
+            this._game = new Game(themed_image_game.script, this._clientIds, this._sendMessageToClientFn, this._sendMessageToClientsFn, this._imageGenerator);
             this._game.start();
             break;
         case "I'd Watch That":
-            this._game = new Game(movie_game.script, this._clientIds, this._sendMessageToClientFn, this._imageGenerator);
+            this._game = new Game(movie_game.script, this._clientIds, this._sendMessageToClientFn, this._sendMessageToClientsFn, this._imageGenerator);
             this._game.start();
             break;
         case "What-the-Doodle":
-            this._game = new Game(drawing_game.script, this._clientIds, this._sendMessageToClientFn, this._imageGenerator);
+            this._game = new Game(drawing_game.script, this._clientIds, this._sendMessageToClientFn, this._sendMessageToClientsFn, this._imageGenerator);
             this._game.start();
             break;
         }
     }
 
-    constructor(sessionId, sendMessageToClientFn, terminateSessionFn, imageGenerator)
+    constructor(sessionId, sendMessageToClientFn, sendMessageToClientsFn, terminateSessionFn, imageGenerator)
     {
         this._game = null;
         this._sessionId = sessionId;
         this._sendMessageToClientFn = sendMessageToClientFn;
+        this._sendMessageToClientsFn = sendMessageToClientsFn;
         this._terminateSessionFn = terminateSessionFn;
         this._imageGenerator = imageGenerator;
     }